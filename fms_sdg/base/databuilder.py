@@ -9,7 +9,12 @@ from fms_sdg.base.generator import BaseGenerator
 from fms_sdg.base.registry import get_generator, get_validator
 from fms_sdg.base.task import SdgData, SdgTask
 from fms_sdg.base.validator import BaseValidator
-from fms_sdg.generators.llm import CachingLM, LMGenerator
+from fms_sdg.generators.llm import (
+    CACHE_SIZE,
+    DEFAULT_CACHE_SIZE,
+    CachingLM,
+    LMGenerator,
+)
 from fms_sdg.utils import all_annotations, sdg_logger
 
 
@@ -104,6 +109,7 @@ class DataBuilder(ABC):
                             # each rank receives a different cache db.
                             # necessary to avoid multiple writes to cache at once
                             + f"_model{os.path.split(obj.model_id_or_path)[-1]}_rank{obj.rank}.db",
+                            cache_size=obj_config.get(CACHE_SIZE, DEFAULT_CACHE_SIZE),
                         )
 
                     type_annotations = all_annotations(type(self))
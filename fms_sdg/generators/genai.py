@@ -79,8 +79,8 @@ class GenAIGenerator(LMGenerator):
     def tok_encode(self, string: str, **kwargs) -> List[int]:
         raise NotImplementedError
 
-    def _encode_pair(self, context, continuation):
-        return context, continuation
+    def _encode_pairs(self, pairs):
+        return [(context, continuation) for context, continuation in pairs]
 
     def _loglikelihood_tokens(
         self, requests, disable_tqdm: bool = False
@@ -11,18 +11,20 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 """
 
 # Standard
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 import abc
-import copy
-import hashlib
-import json
+import collections
 import os
+import queue
+import sqlite3
+import threading
 
 # Third Party
 from genai.schema import TextGenerationParameters
-from sqlitedict import SqliteDict
 from tqdm import tqdm
+import orjson
 import transformers
+import xxhash
 
 # Local
 from fms_sdg.base.generator import BaseGenerator
@@ -30,6 +32,12 @@ from fms_sdg.base.instance import Instance
 from fms_sdg.utils import sdg_logger
 
 MODEL_ID_OR_PATH = "model_id_or_path"
+CACHE_SIZE = "cache_size"
+DEFAULT_CACHE_SIZE = 4096
+# default upper bound on host parameters in a single SQLite statement
+SQLITE_MAX_VARIABLE_NUMBER = 999
+
+_TGP_FIELDS = frozenset(TextGenerationParameters.model_fields)
 
 
 class LMGenerator(BaseGenerator):
@@ -46,11 +54,7 @@ class LMGenerator(BaseGenerator):
         ), f"Must specify model for Generator {name}"
 
         default_kwargs = {"decoding_method": "sample"}
-        cfg_kwargs = {
-            k: v
-            for k, v in copy.deepcopy(self.config).items()
-            if k in TextGenerationParameters.model_fields
-        }
+        cfg_kwargs = {k: v for k, v in self.config.items() if k in _TGP_FIELDS}
         self._base_kwargs = {**default_kwargs, **cfg_kwargs}
 
     @property
@@ -74,6 +78,10 @@ class LMGenerator(BaseGenerator):
     def tok_encode(self, string: str, **kwargs):
         pass
 
+    def tok_batch_encode(self, strings: List[str], **kwargs) -> List[List[int]]:
+        # generators backed by a batched (e.g., Rust) tokenizer should override this
+        return [self.tok_encode(string, **kwargs) for string in strings]
+
     @abc.abstractmethod
     def _loglikelihood_tokens(self, requests, **kwargs):
         pass
@@ -81,41 +89,58 @@ class LMGenerator(BaseGenerator):
     def loglikelihood(
         self, requests: List[Instance], disable_tqdm: bool = False
     ) -> None:
-        new_reqs = []
-        for req in requests:
-            context, continuation = req.args
-            if context == "":
-                # BOS or EOS as context
-                context_enc, continuation_enc = (
-                    [self.prefix_token_id],
-                    self.tok_encode(continuation),
-                )
-            else:
-                context_enc, continuation_enc = self._encode_pair(context, continuation)
+        new_reqs = [None] * len(requests)
+        empty_ctx_idxs, pair_idxs = [], []
+        for i, req in enumerate(requests):
+            context, _ = req.args
+            (empty_ctx_idxs if context == "" else pair_idxs).append(i)
+
+        if empty_ctx_idxs:
+            # BOS or EOS as context
+            continuation_encs = self.tok_batch_encode(
+                [requests[i].args[1] for i in empty_ctx_idxs]
+            )
+            for i, continuation_enc in zip(empty_ctx_idxs, continuation_encs):
+                new_reqs[i] = ([self.prefix_token_id], continuation_enc, requests[i])
 
-            new_reqs.append((context_enc, continuation_enc, req))
+        if pair_idxs:
+            encoded_pairs = self._encode_pairs([requests[i].args for i in pair_idxs])
+            for i, (context_enc, continuation_enc) in zip(pair_idxs, encoded_pairs):
+                new_reqs[i] = (context_enc, continuation_enc, requests[i])
 
         return self._loglikelihood_tokens(new_reqs, disable_tqdm=disable_tqdm)
 
-    def _encode_pair(self, context, continuation):
-        n_spaces = len(context) - len(context.rstrip())
-        if n_spaces > 0:
-            continuation = context[-n_spaces:] + continuation
-            context = context[:-n_spaces]
+    def _encode_pairs(self, pairs: List[Tuple[str, str]]) -> List[Tuple[Any, Any]]:
+        contexts, continuations = [], []
+        for context, continuation in pairs:
+            n_spaces = len(context) - len(context.rstrip())
+            if n_spaces > 0:
+                continuation = context[-n_spaces:] + continuation
+                context = context[:-n_spaces]
+            contexts.append(context)
+            continuations.append(continuation)
 
         model_class = getattr(self, "AUTO_MODEL_CLASS", None)
 
         if model_class == transformers.AutoModelForSeq2SeqLM:
-            context_enc = self.tok_encode(context)
-            continuation_enc = self.tok_encode(continuation, add_special_tokens=False)
+            context_encs = self.tok_batch_encode(contexts)
+            continuation_encs = self.tok_batch_encode(
+                continuations, add_special_tokens=False
+            )
         else:
-            whole_enc = self.tok_encode(context + continuation)
-            context_enc = self.tok_encode(context)
-
-            context_enc_len = len(context_enc)
-            continuation_enc = whole_enc[context_enc_len:]
+            whole_encs = self.tok_batch_encode(
+                [
+                    context + continuation
+                    for context, continuation in zip(contexts, continuations)
+                ]
+            )
+            context_encs = self.tok_batch_encode(contexts)
+            continuation_encs = [
+                whole_enc[len(context_enc) :]
+                for whole_enc, context_enc in zip(whole_encs, context_encs)
+            ]
 
-        return context_enc, continuation_enc
+        return list(zip(context_encs, continuation_encs))
 
     def update_instance_with_result(
         self, text: str, instance: Instance, until: List[str]
@@ -139,44 +164,206 @@ class LMGenerator(BaseGenerator):
 
 ### SQLite-based caching of LM responses
 def hash_args(attr, request):
-    dat = json.dumps([attr] + [request.args, request.kwargs])
-    return hashlib.sha256(dat.encode("utf-8")).hexdigest()
+    # cache keys need no cryptographic strength, so use a fast non-cryptographic hash.
+    # keys are sorted so that equivalent kwargs always map to the same cache entry, and
+    # non-str keys (e.g., token ids in `logit_bias`) are accepted as with `json.dumps`
+    dat = orjson.dumps(
+        (attr, request.args, request.kwargs),
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS,
+    )
+    return xxhash.xxh3_128_hexdigest(dat)
+
+
+def is_sampled(attr, request):
+    # results of non-greedy generation are never served from the cache
+    return (
+        attr == "generate_batch"
+        and request.kwargs.get("decoding_method", None) == "sample"
+    )
+
+
+class SqliteCache:
+    """Minimal dict-like key / value store backed by a single SQLite table.
+
+    The database is opened in WAL mode. Writes are handed to a background thread that
+    persists everything queued so far with a single `executemany` and commit, so that
+    cache writes can overlap with generation. `commit` blocks until all queued writes
+    have been persisted.
+
+    Reads go through a single connection that may be used from any thread, but only
+    from one thread at a time.
+    """
+
+    def __init__(self, cache_db: str) -> None:
+        self.cache_db = cache_db
+        self.conn = self._connect(cache_db, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v BLOB)")
+        self.conn.commit()
+
+        # each queued batch is paired with an event the writer sets once it is persisted
+        self._queue: queue.Queue = queue.Queue()
+        self._last_written: Optional[threading.Event] = None
+        self._write_error: Optional[Exception] = None
+        self._writer = threading.Thread(
+            target=self._write_loop, args=(cache_db,), daemon=True
+        )
+        self._writer.start()
+
+    @staticmethod
+    def _connect(cache_db: str, **kwargs: Any) -> sqlite3.Connection:
+        conn = sqlite3.connect(cache_db, **kwargs)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _write_loop(self, cache_db: str) -> None:
+        try:
+            conn = self._connect(cache_db)
+        except Exception as e:
+            # surfaced by `commit`, which stops waiting once this thread has exited
+            self._write_error = e
+            return
+        while True:
+            batches = [self._queue.get()]
+            # gather everything else already queued so it lands in the same transaction
+            while True:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                rows = [
+                    row for batch in batches if batch is not None for row in batch[0]
+                ]
+                if rows:
+                    conn.executemany("INSERT OR REPLACE INTO kv(k,v) VALUES(?,?)", rows)
+                    conn.commit()
+            except Exception as e:
+                self._write_error = e
+            finally:
+                for batch in batches:
+                    if batch is not None:
+                        batch[1].set()
+            if None in batches:
+                conn.close()
+                return
+
+    def _get(self, key: str):
+        return self.conn.execute("SELECT v FROM kv WHERE k=?", (key,)).fetchone()
+
+    def __contains__(self, key: str) -> bool:
+        return self._get(key) is not None
+
+    def __getitem__(self, key: str) -> Any:
+        row = self._get(key)
+        if row is None:
+            raise KeyError(key)
+        return orjson.loads(row[0])
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """Fetches all of `keys` present in the cache with as few queries as possible"""
+        found = dict()
+        keys = list(dict.fromkeys(keys))
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLE_NUMBER):
+            chunk = keys[i : i + SQLITE_MAX_VARIABLE_NUMBER]
+            found.update(
+                self.conn.execute(
+                    f"SELECT k,v FROM kv WHERE k IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        return {k: orjson.loads(v) for k, v in found.items()}
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.update([(key, value)])
+
+    def update(self, items: List[Tuple[str, Any]]) -> None:
+        self._check_writer()
+        self._last_written = threading.Event()
+        self._queue.put(([(k, orjson.dumps(v)) for k, v in items], self._last_written))
+
+    def commit(self) -> None:
+        # batches are written in order, so waiting on the last one covers all of them.
+        # stop waiting if the writer thread has exited, as the event would never be set
+        if self._last_written is not None:
+            while not self._last_written.wait(timeout=0.1):
+                if not self._writer.is_alive():
+                    break
+            self._last_written = None
+        if self._write_error is not None:
+            err, self._write_error = self._write_error, None
+            raise err
+        self._check_writer()
+
+    def _check_writer(self) -> None:
+        if not self._writer.is_alive():
+            raise RuntimeError(
+                f"Writer thread for cache '{self.cache_db}' is not running (was the cache closed?)"
+            )
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self.conn.close()
+        if self._write_error is not None:
+            err, self._write_error = self._write_error, None
+            raise err
 
 
 class CacheHook:
     def __init__(self, cachinglm) -> None:
+        # hashes already computed by CachingLM for the requests it is waiting on
+        self._pending: Dict[Tuple[str, int], str] = dict()
         if cachinglm is None:
             self.dbdict = None
             return
 
-        self.dbdict: SqliteDict = cachinglm.dbdict
+        self.dbdict: SqliteCache = cachinglm.dbdict
 
     def add_partial(self, attr, req, res) -> None:
-        if self.dbdict is None:
+        if self.dbdict is None or is_sampled(attr, req):
             return
-        hsh = hash_args(attr, req)
+        hsh = self._pending.pop((attr, id(req)), None)
+        if hsh is None:
+            hsh = hash_args(attr, req)
         self.dbdict[hsh] = res
 
+    def set_pending(self, attr, hashed_reqs: List[Tuple[Instance, str]]) -> None:
+        self._pending = {(attr, id(req)): hsh for req, hsh in hashed_reqs}
+
+    def pop_pending(self, attr, req) -> Union[str, None]:
+        """Returns the hash of `req` if its result has not been stored through `add_partial`"""
+        return self._pending.pop((attr, id(req)), None)
+
 
 class CachingLM:
-    def __init__(self, lm: LMGenerator, cache_db) -> None:
+    def __init__(
+        self, lm: LMGenerator, cache_db, cache_size: int = DEFAULT_CACHE_SIZE
+    ) -> None:
         """LM wrapper that returns cached results if they exist, and uses the underlying LM if not.
 
         :param lm: LM
             Underlying LM
         :param cache_db: str
             Path to cache db
+        :param cache_size: int
+            Number of responses to keep in memory in front of the cache db
         """
         self.lm = lm
         self.cache_db = cache_db
         if os.path.dirname(cache_db):
             os.makedirs(os.path.dirname(cache_db), exist_ok=True)
-        self.dbdict = SqliteDict(cache_db, autocommit=True)
+        self.dbdict = SqliteCache(cache_db)
 
-        # add hook to lm
-        lm.set_cache_hook(self.get_cache_hook())
+        # in-memory LRU layer in front of the cache db
+        self.cache_size = int(cache_size)
+        self._mem: collections.OrderedDict = collections.OrderedDict()
 
-        self.dbdict
+        # add hook to lm
+        self._cache_hook = self.get_cache_hook()
+        lm.set_cache_hook(self._cache_hook)
 
     def __getattr__(self, attr):
         lm_attr = getattr(self.lm, attr)
@@ -191,12 +378,23 @@ class CachingLM:
             sdg_logger.info(
                 f"Loading '{attr}' responses from cache '{self.cache_db}' where possible..."
             )
-            for req in tqdm(requests, desc="Checking cached requests"):
-                hsh = hash_args(attr, req)
-                if (
-                    attr == "generate_batch"
-                    and req.kwargs.get("decoding_method", None) == "sample"
-                ):
+            # sampled requests are never served from the cache, so they get no hash
+            hashes = [
+                None if is_sampled(attr, req) else hash_args(attr, req)
+                for req in requests
+            ]
+            lookups = [hsh for hsh in hashes if hsh is not None]
+            # only go to the cache db for what is not already held in memory
+            cached = {hsh: self._mem[hsh] for hsh in lookups if hsh in self._mem}
+            cached.update(
+                self.dbdict.get_many([hsh for hsh in lookups if hsh not in cached])
+            )
+            for i, (req, hsh) in tqdm(
+                enumerate(zip(requests, hashes)),
+                total=len(requests),
+                desc="Checking cached requests",
+            ):
+                if hsh is None:
                     # when we are doing non-greedy generation, don't use the cache
                     # (else every "randomly sampled" generation would be identical for repeats > 1).
                     if not warned:
@@ -205,40 +403,61 @@ class CachingLM:
                         )
                         warned = True
                     res.append(None)
-                    remaining_reqs.append(req)
-                elif hsh in self.dbdict:
-                    ob = self.dbdict[hsh]
+                    remaining_reqs.append((i, req, None))
+                elif hsh in cached:
+                    ob = cached[hsh]
                     assert ob is not None
+                    self._remember(hsh, ob)
                     res.append(ob)
                 else:
                     res.append(None)
-                    remaining_reqs.append(req)
+                    remaining_reqs.append((i, req, hsh))
 
             sdg_logger.info(
                 f"Cached requests: {len(requests) - len(remaining_reqs)}, Requests remaining: {len(remaining_reqs)}"
             )
 
-            # actually run the LM on the requests that do not have cached results
-            getattr(self.lm, attr)(remaining_reqs)
+            # actually run the LM on the requests that do not have cached results,
+            # letting the cache hook reuse the hashes computed above
+            self._cache_hook.set_pending(
+                attr, [(req, hsh) for _, req, hsh in remaining_reqs if hsh is not None]
+            )
+            getattr(self.lm, attr)([req for _, req, _ in remaining_reqs])
 
             # stick the new ones back into the list and also cache any of the new ones
-            resptr = 0
-            for req in remaining_reqs:
-                while res[resptr] is not None:
-                    resptr += 1
-
-                res[resptr] = req.result
+            rows = []
+            for i, req, hsh in remaining_reqs:
+                res[i] = req.result
 
                 # caching
-                hsh = hash_args(attr, req)
-                self.dbdict[hsh] = req.result
-            self.dbdict.commit()
+                if hsh is None:
+                    continue
+                self._remember(hsh, req.result)
+                # results already stored through the cache hook are not written again
+                if self._cache_hook.pop_pending(attr, req) is not None:
+                    rows.append((hsh, req.result))
+            self._cache_hook.set_pending(attr, [])
+            # writes are persisted by the cache's writer thread in the background
+            self.dbdict.update(rows)
 
             # now we store result
             for req, req_res in zip(requests, res):
                 req.result = req_res
 
+            # wait until the writer thread has committed everything for this call
+            self.dbdict.commit()
+
         return fn
 
+    def _remember(self, hsh: str, ob: Any) -> None:
+        self._mem[hsh] = ob
+        self._mem.move_to_end(hsh)
+        if len(self._mem) > self.cache_size:
+            self._mem.popitem(last=False)
+
     def get_cache_hook(self):
         return CacheHook(self)
+
+    def close(self) -> None:
+        """Waits for pending cache writes and closes the cache db"""
+        self.dbdict.close()
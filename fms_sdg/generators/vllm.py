@@ -14,10 +14,8 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 from importlib.metadata import version
 from importlib.util import find_spec
 from typing import Any, Dict, List, Literal, Optional, Tuple, Union
-import copy
 
 # Third Party
-from more_itertools import distribute
 from packaging.version import parse as parse_version
 from tqdm import tqdm
 
@@ -135,6 +133,8 @@ class vLLMGenerator(LMGenerator):
             self._config = AutoConfig.from_pretrained(
                 pretrained, trust_remote_code=trust_remote_code, revision=revision
             )
+        # chunk size used when batching requests (0 lets vLLM schedule everything at once)
+        self._batch_n = 0 if self.batch_size == "auto" else int(self.batch_size)
         self.tokenizer = get_tokenizer(
             tokenizer if tokenizer else pretrained,
             tokenizer_mode=tokenizer_mode,
@@ -149,6 +149,12 @@ class vLLMGenerator(LMGenerator):
             )
 
         self._max_gen_toks = max_gen_toks
+        # decoded once here, as it is appended to the stop sequences of every chunk
+        self._eos_str = self.tokenizer.decode(self.eot_token_id)
+        # sampling params for loglikelihood requests never change, so build them once
+        self._ll_sampling_params = SamplingParams(
+            temperature=0, prompt_logprobs=1, max_tokens=1
+        )
 
     @property
     def eot_token_id(self):
@@ -205,20 +211,30 @@ class vLLMGenerator(LMGenerator):
 
         return encoding
 
+    def tok_batch_encode(
+        self,
+        strings: List[str],
+        add_special_tokens=None,
+    ) -> List[List[int]]:
+        if not add_special_tokens:
+            add_special_tokens = False or self.add_bos_token
+        # a single call lets the fast tokenizer encode the whole batch at once
+        return self.tokenizer(
+            strings,
+            add_special_tokens=add_special_tokens,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        ).input_ids
+
     def _model_generate(
         self,
         requests: List[List[int]] = None,
-        generate: bool = False,
-        stop: Optional[List[str]] = None,
-        **kwargs,
+        sampling_params=None,
     ):
-        if generate:
-            kwargs = self.modify_gen_kwargs(kwargs)
-            sampling_params = SamplingParams(stop=stop, **kwargs)
-        else:
-            sampling_params = SamplingParams(
-                temperature=0, prompt_logprobs=1, max_tokens=1
-            )
+        # generation passes the sampling params built for its kwargs group,
+        # loglikelihood requests use the fixed params built at init
+        if sampling_params is None:
+            sampling_params = self._ll_sampling_params
         if self.data_parallel_size > 1:
             # vLLM hangs if tensor_parallel > 1 and resources are set in ray.remote
             # also seems to only work with decorator and not with ray.remote() fn
@@ -236,7 +252,12 @@ class vLLMGenerator(LMGenerator):
 
             # dispatch requests to all self.data_parallel_size workers, in interleaved fashion
             # interleaved important to balance context lengths across workers
-            requests = [list(x) for x in distribute(self.data_parallel_size, requests)]
+            # (slicing gives the same split as more_itertools.distribute without the
+            # per-element generator overhead)
+            requests = [
+                requests[i :: self.data_parallel_size]
+                for i in range(self.data_parallel_size)
+            ]
             inputs = ((self.model_args, sampling_params, req) for req in requests)
             object_refs = [run_inference_one_model.remote(*x) for x in inputs]
             results = ray.get(object_refs)
@@ -257,7 +278,12 @@ class vLLMGenerator(LMGenerator):
     ) -> None:
         # batch tokenize contexts
         context = [req.args[0] for req in requests]
-        context_encoding = self.tokenizer(context, add_special_tokens=False).input_ids
+        context_encoding = self.tokenizer(
+            context,
+            add_special_tokens=False,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        ).input_ids
         request_list = [
             ((a, b), c) for a, b, c in zip(context, context_encoding, requests)
         ]
@@ -270,60 +296,73 @@ class vLLMGenerator(LMGenerator):
         )
 
         for key, c_ce_reqs in grouper.get_grouped().items():
+            # sort by context length (descending) so each chunk holds similarly sized
+            # inputs; results are written onto the instances, so order is preserved
+            c_ce_reqs = sorted(c_ce_reqs, key=lambda x: -len(x[0][1]))
+
+            # all kwargs are identical within a group
+            gen_kwargs = c_ce_reqs[0][1].kwargs
+
+            # unpack our keyword arguments.
+            until = None
+            if isinstance(gen_kwargs, dict):
+                # start with default params in self.config then overwrite with kwargs
+                kwargs = {**self._base_kwargs, **gen_kwargs}
+                if "stop_sequences" in kwargs:
+                    until = kwargs.pop("stop_sequences")
+                    if isinstance(until, str):
+                        until = [until]
+                    elif isinstance(until, list):
+                        # copy so the request's own stop sequences are left untouched
+                        until = list(until)
+                    else:
+                        raise ValueError(
+                            f"Expected `kwargs['stop_sequences']` to be of type Union[str,list] but got {until}"
+                        )
+                kwargs["max_tokens"] = self.max_gen_toks
+                if "max_new_tokens" in kwargs.keys():
+                    kwargs["max_tokens"] = kwargs.pop("max_new_tokens")
+                if "min_new_tokens" in kwargs:
+                    kwargs["min_tokens"] = kwargs.pop("min_new_tokens")
+                if "decoding_method" in kwargs:
+                    kwargs["do_sample"] = kwargs.pop("decoding_method") == "sample"
+            else:
+                raise ValueError(
+                    f"Expected `kwargs` to be of type `dict` but got {gen_kwargs}"
+                )
+            # add EOS token to stop sequences
+            if not until:
+                until = [self._eos_str]
+            else:
+                until.append(self._eos_str)
+
+            # set the max length in tokens of inputs ("context_enc")
+            # max len for inputs = max length, minus room to generate the max new tokens
+            max_ctx_len = self.max_length - kwargs["max_tokens"]
+
+            # sampling params only depend on the group's kwargs, so share them across chunks
+            sampling_params = SamplingParams(
+                stop=until, **self.modify_gen_kwargs(dict(kwargs))
+            )
 
             chunks = generator_utils.chunks(
                 c_ce_reqs,
-                n=int(self.batch_size) if self.batch_size != "auto" else 0,
+                n=self._batch_n,
             )
 
             for chunk in chunks:
                 context_and_encoding, chunk_instances = zip(*chunk)
                 context, context_encoding = zip(*context_and_encoding)
-                # all kwargs are identical within a chunk
-                gen_kwargs = next(iter(chunk_instances)).kwargs
-
-                # unpack our keyword arguments.
-                until = None
-                if isinstance(kwargs := copy.deepcopy(gen_kwargs), dict):
-                    # start with default params in self.config then overwrite with kwargs
-                    kwargs = {**self._base_kwargs, **kwargs}
-                    if "stop_sequences" in kwargs:
-                        until = kwargs.pop("stop_sequences")
-                        if isinstance(until, str):
-                            until = [until]
-                        elif not isinstance(until, list):
-                            raise ValueError(
-                                f"Expected `kwargs['stop_sequences']` to be of type Union[str,list] but got {until}"
-                            )
-                    kwargs["max_tokens"] = self.max_gen_toks
-                    if "max_new_tokens" in kwargs.keys():
-                        kwargs["max_tokens"] = kwargs.pop("max_new_tokens")
-                    if "min_new_tokens" in kwargs:
-                        kwargs["min_tokens"] = kwargs.pop("min_new_tokens")
-                    if "decoding_method" in kwargs:
-                        kwargs["do_sample"] = kwargs.pop("decoding_method") == "sample"
-                else:
-                    raise ValueError(
-                        f"Expected `kwargs` to be of type `dict` but got {gen_kwargs}"
-                    )
-                # add EOS token to stop sequences
-                eos = self.tokenizer.decode(self.eot_token_id)
-                if not until:
-                    until = [eos]
-                else:
-                    until.append(eos)
-
-                # set the max length in tokens of inputs ("context_enc")
-                # max len for inputs = max length, minus room to generate the max new tokens
-                max_ctx_len = self.max_length - kwargs["max_tokens"]
-                context_encoding = [x[-max_ctx_len:] for x in context_encoding]
+                # only copy the encodings that actually need left-truncation
+                context_encoding = [
+                    x if len(x) <= max_ctx_len else x[-max_ctx_len:]
+                    for x in context_encoding
+                ]
 
                 # perform batched generation
                 cont = self._model_generate(
                     requests=context_encoding,
-                    generate=True,
-                    stop=until,
-                    **kwargs,
+                    sampling_params=sampling_params,
                 )
 
                 for output, instance in zip(cont, chunk_instances):
@@ -346,28 +385,29 @@ class vLLMGenerator(LMGenerator):
 
         # Reorder requests by length and batch
         re_ord = Collator(requests, sort_fn=_collate)
-        chunks = re_ord.get_batched(
-            n=int(self.batch_size) if self.batch_size != "auto" else 0, batch_fn=None
-        )
+        chunks = re_ord.get_batched(n=self._batch_n, batch_fn=None)
 
         pbar = tqdm(
             total=len(requests),
             disable=disable_tqdm,
             desc="Running loglikelihood requests",
         )
+        max_length = self.max_length
         for chunk in chunks:
             inputs = []
             ctxlens = []
             for cache_key, context_enc, continuation_enc in chunk:
-                inp = (context_enc + continuation_enc)[-(self.max_length) :]
-                ctxlen = len(context_enc) - max(
-                    0, len(context_enc) + len(continuation_enc) - (self.max_length)
-                )
+                inp = context_enc + continuation_enc
+                # left-truncate to at most max_length tokens, slicing only when needed
+                overflow = max(0, len(inp) - max_length)
+                if overflow:
+                    inp = inp[overflow:]
+                ctxlen = len(context_enc) - overflow
 
                 inputs.append(inp)
                 ctxlens.append(ctxlen)
 
-            outputs = self._model_generate(requests=inputs, generate=False)
+            outputs = self._model_generate(requests=inputs)
 
             for output, ctxlen, (cache_key, _, _), inp in zip(
                 outputs, ctxlens, chunk, inputs
@@ -405,36 +445,21 @@ class vLLMGenerator(LMGenerator):
         # The first entry of prompt_logprobs is None because the model has no previous tokens to condition on.
         continuation_logprobs_dicts = outputs.prompt_logprobs
 
-        def coerce_logprob_to_num(logprob):
+        # Calculate continuation_logprobs in a single pass over the continuation tokens
+        # assume ctxlen always >= 1
+        continuation_logprobs = 0.0
+        for token, logprob_dict in zip(
+            tokens[ctxlen:], continuation_logprobs_dicts[ctxlen:]
+        ):
+            logprob = logprob_dict[token]
             # vLLM changed the return type of logprobs from float
             # to a Logprob object storing the float value + extra data
             # (https://github.com/vllm-project/vllm/pull/3065).
-            # If we are dealing with vllm's Logprob object, return
+            # If we are dealing with vllm's Logprob object, use
             # the logprob value stored as an attribute. Otherwise,
-            # return the object itself (which should be a float
+            # use the object itself (which should be a float
             # for older versions of vLLM).
-            return getattr(logprob, "logprob", logprob)
-
-        continuation_logprobs_dicts = [
-            (
-                {
-                    token: coerce_logprob_to_num(logprob)
-                    for token, logprob in logprob_dict.items()
-                }
-                if logprob_dict is not None
-                else None
-            )
-            for logprob_dict in continuation_logprobs_dicts
-        ]
-
-        # Calculate continuation_logprobs
-        # assume ctxlen always >= 1
-        continuation_logprobs = sum(
-            logprob_dict.get(token)
-            for token, logprob_dict in zip(
-                tokens[ctxlen:], continuation_logprobs_dicts[ctxlen:]
-            )
-        )
+            continuation_logprobs += getattr(logprob, "logprob", logprob)
 
         # # Determine if is_greedy
         # is_greedy = True
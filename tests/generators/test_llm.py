@@ -2,15 +2,19 @@
 from typing import List
 import copy
 import os
+import re
+import sqlite3
 import time
 
 # Third Party
 import pytest
 
 # Local
+from fms_sdg.base.databuilder import DataBuilder
 from fms_sdg.base.instance import Instance
-from fms_sdg.base.registry import get_generator
-from fms_sdg.generators.llm import CachingLM, LMGenerator
+from fms_sdg.base.registry import get_generator, register_generator
+from fms_sdg.generators.llm import CachingLM, LMGenerator, SqliteCache, hash_args
+import fms_sdg.generators.llm as llm
 
 GREEDY_CFG = {
     "type": "genai",
@@ -23,6 +27,34 @@ GREEDY_CFG = {
 PROMPTS = [f"Question: x = {i} + 1\nAnswer: x =" for i in range(25)]
 
 
+@register_generator("test_stub")
+class StubLM(LMGenerator):
+    """Offline LM that tokenizes on whitespace and upper-cases prompts"""
+
+    def __init__(self, name: str = "test_stub", config: dict = None, **kwargs):
+        super().__init__(name, {"model_id_or_path": "stub", **(config or {})}, **kwargs)
+        self.generated = []
+
+    @property
+    def eot_token_id(self):
+        return "<eos>"
+
+    def tok_encode(self, string: str, **kwargs):
+        return re.findall(r"\s*\S+|\s+", string)
+
+    def _loglikelihood_tokens(self, requests, **kwargs):
+        return requests
+
+    def generate_batch(self, requests: List[Instance], **kwargs) -> None:
+        for req in requests:
+            self.generated.append(req.args[0])
+            self.update_instance_with_result(req.args[0].upper(), req, None)
+
+
+class StubDataBuilder(DataBuilder):
+    llm1: StubLM
+
+
 class TestLlmGenerators:
     @pytest.mark.parametrize("model_backend", ["genai"])
     def test_generate_batch(self, model_backend):
@@ -45,6 +77,35 @@ class TestLlmGenerators:
             ), f"Input list has been rearranged at index {i}"
             assert isinstance(inp.result, str)
 
+    def test_loglikelihood_encoding(self):
+        lm = StubLM()
+        requests = [
+            Instance(["The cat ", "sat down"]),
+            Instance(["", "hello world"]),
+            Instance(["A dog", " ran"]),
+        ]
+        encoded = lm.loglikelihood(requests)
+
+        # mixed empty and non-empty contexts keep their original order
+        assert len(encoded) == len(requests)
+        assert all(req is orig for (_, _, req), orig in zip(encoded, requests))
+
+        # trailing whitespace of the context moves into the continuation
+        context_enc, continuation_enc, _ = encoded[0]
+        assert context_enc == lm.tok_encode("The cat")
+        assert continuation_enc == [" sat", " down"]
+        whole_enc = lm.tok_encode("The cat sat down")
+        assert continuation_enc == whole_enc[len(context_enc) :]
+
+        # empty contexts are replaced by the prefix token
+        context_enc, continuation_enc, _ = encoded[1]
+        assert context_enc == [lm.prefix_token_id]
+        assert continuation_enc == lm.tok_encode("hello world")
+
+        context_enc, continuation_enc, _ = encoded[2]
+        assert context_enc == ["A", " dog"]
+        assert continuation_enc == lm.tok_encode("A dog ran")[len(context_enc) :]
+
     def test_lm_caching(self):
         cache_path = os.path.join(
             os.path.dirname(os.path.abspath(__file__)), "tmp_cache.db"
@@ -82,7 +143,10 @@ class TestLlmGenerators:
         cache_lm.generate_batch(post_cache_inputs)
         post_cache_time = time.time() - post_cache_time
 
-        os.remove(cache_path)
+        cache_lm.close()
+        for path in [cache_path, cache_path + "-wal", cache_path + "-shm"]:
+            if os.path.exists(path):
+                os.remove(path)
 
         assert (
             post_cache_time < pre_cache_time and post_cache_time < non_cache_time
@@ -97,3 +161,204 @@ class TestLlmGenerators:
             assert (
                 non.result == pre.result == post.result
             ), f"Different results detected at index {i}: {(non.result, pre.result, post.result)}"
+
+
+class TestLMCache:
+    def test_hash_args(self):
+        req = Instance(["prompt"], {"max_new_tokens": 5, "decoding_method": "greedy"})
+        reordered = Instance(
+            ["prompt"], {"decoding_method": "greedy", "max_new_tokens": 5}
+        )
+        assert hash_args("generate_batch", req) == hash_args(
+            "generate_batch", reordered
+        )
+        assert hash_args("generate_batch", req) != hash_args("loglikelihood", req)
+
+        # non-str dict keys, e.g., token ids from a yaml config
+        req = Instance(["prompt"], {"logit_bias": {50256: -100, 13: 5}})
+        reordered = Instance(["prompt"], {"logit_bias": {13: 5, 50256: -100}})
+        assert hash_args("generate_batch", req) == hash_args(
+            "generate_batch", reordered
+        )
+
+    def test_sqlite_cache(self, tmp_path):
+        cache_db = str(tmp_path / "cache.db")
+        # more keys than fit in a single SQLite statement
+        items = [(str(i), f"result {i}") for i in range(2500)]
+
+        cache = SqliteCache(cache_db)
+        cache.update(items)
+        cache.commit()
+        found = cache.get_many([k for k, _ in items] + ["missing"])
+        assert found == dict(items)
+        assert "0" in cache and cache["0"] == "result 0" and "missing" not in cache
+        cache.close()
+
+        cache = SqliteCache(cache_db)
+        assert cache.get_many([k for k, _ in items]) == dict(items)
+        cache.close()
+
+    def test_sqlite_cache_write_error(self, tmp_path):
+        cache = SqliteCache(str(tmp_path / "cache.db"))
+        cache.conn.execute("DROP TABLE kv")
+        cache.conn.commit()
+
+        cache.update([("a", 1)])
+        with pytest.raises(sqlite3.OperationalError):
+            cache.commit()
+        cache.close()
+
+        with pytest.raises(RuntimeError):
+            cache.update([("b", 2)])
+
+    def test_sqlite_cache_writer_connect_error(self, tmp_path, monkeypatch):
+        connect = SqliteCache._connect
+
+        def _connect(cache_db, **kwargs):
+            # only the writer thread opens its connection without kwargs
+            if not kwargs:
+                raise sqlite3.OperationalError("unable to open database file")
+            return connect(cache_db, **kwargs)
+
+        monkeypatch.setattr(SqliteCache, "_connect", staticmethod(_connect))
+        cache = SqliteCache(str(tmp_path / "cache.db"))
+        cache._writer.join()
+
+        # commit raises the writer's error instead of waiting forever
+        with pytest.raises(sqlite3.OperationalError):
+            cache.commit()
+        with pytest.raises(RuntimeError):
+            cache.update([("a", 1)])
+        cache.close()
+
+    def test_caching_lm(self, tmp_path):
+        cache_db = str(tmp_path / "cache.db")
+
+        lm = StubLM()
+        cache_lm = CachingLM(lm, cache_db)
+        inputs = [Instance([prompt]) for prompt in PROMPTS]
+        cache_lm.generate_batch(inputs)
+        assert lm.generated == PROMPTS
+        assert [inp.result for inp in inputs] == [p.upper() for p in PROMPTS]
+        cache_lm.close()
+
+        # a reopened cache serves every request without calling the LM
+        lm = StubLM()
+        cache_lm = CachingLM(lm, cache_db)
+        inputs = [Instance([prompt]) for prompt in PROMPTS]
+        cache_lm.generate_batch(inputs)
+        assert lm.generated == []
+        assert [inp.result for inp in inputs] == [p.upper() for p in PROMPTS]
+        cache_lm.close()
+
+    def test_caching_lm_memory(self, tmp_path):
+        lm = StubLM()
+        cache_lm = CachingLM(lm, str(tmp_path / "cache.db"), cache_size=3)
+        prompts = [f"prompt {i}" for i in range(5)]
+
+        cache_lm.generate_batch([Instance([p]) for p in prompts])
+        # only the most recently written entries are kept, oldest first
+        assert list(cache_lm._mem.values()) == [p.upper() for p in prompts[2:]]
+
+        # hits for entries held in memory never reach the cache db
+        cache_lm.dbdict.conn.execute("DELETE FROM kv")
+        cache_lm.dbdict.conn.commit()
+        inputs = [Instance([p]) for p in prompts[2:4]]
+        cache_lm.generate_batch(inputs)
+        assert [inp.result for inp in inputs] == [p.upper() for p in prompts[2:4]]
+        assert lm.generated == prompts
+
+        # hits move to the back, so the least recently used entry is evicted
+        cache_lm.generate_batch([Instance(["new prompt"])])
+        assert list(cache_lm._mem.values()) == [
+            prompts[2].upper(),
+            prompts[3].upper(),
+            "NEW PROMPT",
+        ]
+
+        # sampled results are never served, so they are neither remembered nor stored
+        cache_lm.generate_batch([Instance(["sampled"], {"decoding_method": "sample"})])
+        assert "SAMPLED" not in cache_lm._mem.values()
+        assert (
+            cache_lm.dbdict.get_many(
+                [
+                    hash_args(
+                        "generate_batch",
+                        Instance(["sampled"], {"decoding_method": "sample"}),
+                    )
+                ]
+            )
+            == {}
+        )
+        cache_lm.close()
+
+    def test_caching_lm_skips_sampled_lookups(self, tmp_path):
+        cache_lm = CachingLM(StubLM(), str(tmp_path / "cache.db"))
+        get_many = cache_lm.dbdict.get_many
+        looked_up = []
+
+        def _get_many(keys):
+            looked_up.extend(keys)
+            return get_many(keys)
+
+        cache_lm.dbdict.get_many = _get_many
+
+        greedy = Instance(["greedy"])
+        sampled = Instance(["sampled"], {"decoding_method": "sample"})
+        cache_lm.generate_batch([greedy, sampled])
+        assert looked_up == [hash_args("generate_batch", greedy)]
+        assert [greedy.result, sampled.result] == ["GREEDY", "SAMPLED"]
+        cache_lm.close()
+
+    def test_caching_lm_writes_once_per_miss(self, tmp_path, monkeypatch):
+        hashed = []
+
+        def _hash_args(attr, request):
+            hashed.append(request.args[0])
+            return hash_args(attr, request)
+
+        monkeypatch.setattr(llm, "hash_args", _hash_args)
+
+        cache_lm = CachingLM(StubLM(), str(tmp_path / "cache.db"))
+        update = cache_lm.dbdict.update
+        queued = []
+
+        def _update(items):
+            queued.extend(k for k, _ in items)
+            update(items)
+
+        cache_lm.dbdict.update = _update
+
+        cache_lm.generate_batch([Instance([p]) for p in PROMPTS])
+        # StubLM reports each result through the cache hook, which reuses the hash
+        assert hashed == PROMPTS
+        assert sorted(queued) == sorted(
+            hash_args("generate_batch", Instance([p])) for p in PROMPTS
+        )
+
+        # an LM that never calls the hook still gets each miss written once
+        cache_lm.lm.update_instance_with_result = lambda text, instance, until: setattr(
+            instance, "result", text
+        )
+        queued.clear()
+        cache_lm.generate_batch([Instance(["another prompt"])])
+        assert queued == [hash_args("generate_batch", Instance(["another prompt"]))]
+        cache_lm.close()
+
+    def test_cache_size_config(self, tmp_path):
+        builder = StubDataBuilder(
+            config={
+                "name": "test_stub",
+                "generators": {
+                    "llm1": {
+                        "type": "test_stub",
+                        "model_id_or_path": "stub",
+                        "cache_size": 3,
+                    }
+                },
+            },
+            lm_cache=str(tmp_path / "cache"),
+        )
+        assert isinstance(builder.llm1, CachingLM)
+        assert builder.llm1.cache_size == 3
+        builder.llm1.close()